@@ -1,18 +1,29 @@
 import pandas as pd
 import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 from datetime import datetime, timedelta
 import os
+import re
 import json
 
 # --- 配置 ---
 # 直接复用现有的 Secret
 JSON_KEY = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
 SHEET_NAME = 'Coros_Running_Data'
+SHEET_ID = os.getenv('COROS_SHEET_ID') # 可选：表格 ID (URL 中 /d/ 后面那一段)
+# 配速格式 5'30"：分钟 + 秒
+PACE_RE = re.compile(r"^\s*(\d+)'(\d+)\"?\s*$")
+
+# 认证后的 gspread 客户端，同一进程内只认证一次
+_client = None
 
 def get_client():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    global _client
+    if _client:
+        return _client
+
+    scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
     if not JSON_KEY:
         print("❌ 错误：未找到 Google Credentials Secret")
         return None
@@ -20,12 +31,19 @@ def get_client():
     # 兼容处理：如果是 JSON 字符串直接加载
     try:
         creds_dict = json.loads(JSON_KEY)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        return gspread.authorize(creds)
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+        _client = gspread.authorize(creds)
+        return _client
     except Exception as e:
         print(f"❌ 认证失败: {e}")
         return None
 
+def open_spreadsheet(client):
+    """📂 优先按 ID 打开表格 (省去一次 Drive 按名称搜索)，未配置 ID 时按名称查找"""
+    if SHEET_ID:
+        return client.open_by_key(SHEET_ID)
+    return client.open(SHEET_NAME)
+
 def validate_settings(settings_df):
     """🛡️ 校验 Settings 表格数据的合法性"""
     required_cols = ['Date', 'Max HR', 'Rest HR']
@@ -33,6 +51,10 @@ def validate_settings(settings_df):
     if not all(col in settings_df.columns for col in required_cols):
         print(f"❌ Settings 表缺少列，必须包含: {required_cols}")
         return False
+    # 只有表头、没有任何设置行时，all() 对空列恒为 True，这里要单独拦下来
+    if settings_df.empty:
+        print("❌ Settings 表没有数据行")
+        return False
     # 检查数值
     try:
         if not pd.to_numeric(settings_df['Max HR'], errors='coerce').notnull().all():
@@ -43,47 +65,64 @@ def validate_settings(settings_df):
         return False
     return True
 
-def get_hr_params(date, settings_df):
-    """📅 根据跑步日期，查找当时生效的心率参数"""
-    target_date = pd.to_datetime(date)
-    # 找到所有生效日期在“跑步日期之前”的设置
-    valid_settings = settings_df[settings_df['Date'] <= target_date]
-    
-    if valid_settings.empty:
-        # 如果找不到，用最早的一条
-        return settings_df.iloc[0]['Max HR'], settings_df.iloc[0]['Rest HR']
-    
-    # 取最后一条（也就是离跑步日期最近的一条过去配置）
-    latest = valid_settings.iloc[-1]
-    return latest['Max HR'], latest['Rest HR']
+def get_hr_params(dates, settings_df):
+    """
+    📅 根据跑步日期，批量查找当时生效的心率参数
+    利用 merge_asof 一次性匹配每个日期之前最近的一条设置 (dates 需按时间正序)
+    """
+    runs = pd.DataFrame({'Date': dates.values})
+    settings = settings_df[['Date', 'Max HR', 'Rest HR']]
+
+    # 如果跑步日期比第一条设置还早，用最早的一条：最前面垫一条 1970 年的哨兵记录，省掉之后的 fillna
+    sentinel = settings.iloc[:1].copy()
+    sentinel['Date'] = pd.Timestamp('1970-01-01')
+    settings = pd.concat([sentinel, settings], ignore_index=True)
+    merged = pd.merge_asof(runs, settings, on='Date', direction='backward')
+
+    return pd.to_numeric(merged['Max HR']).to_numpy(dtype=float), pd.to_numeric(merged['Rest HR']).to_numpy(dtype=float)
 # ... import 部分保持不变 ...
 
-def calculate_run_vdot(distance_km, duration_min):
+def predict_5k_min(distance_km, duration_min):
     """
-    🧪 核心算法：估算单次跑步的 VDOT
-    逻辑：先利用 Riegel 公式将本次表现归一化为 "5km 等效成绩"，
-    再利用 Daniels 近似公式计算 VDOT。
+    🧪 核心算法第一步：用 Riegel 公式把每次跑步归一化为 "5km 等效成绩" (分钟)
+    无效数据返回 inf，这样取最小值时自然被忽略。
     """
-    # 1. 过滤无效数据：距离太短或太长都不准，配速太慢也不算
-    if distance_km < 3 or duration_min <= 0: return 0
+    d = np.asarray(distance_km, dtype=float)
+    t = np.asarray(duration_min, dtype=float)
+    pred = np.full(d.shape, np.inf)
+
+    # 1. 过滤无效数据：距离太短或太长都不准，配速太慢也不算 (NaN 比较结果为 False)
+    valid = (d >= 3) & (t > 0)
     
     # 2. Riegel 公式归一化到 5km (预测尽力跑 5km 的用时)
     # T2 = T1 * (D2 / D1)^1.06
     # 这里的假设是：如果你这次跑得很快，Riegel 会预测出一个很快的 5k
-    # 如果你是慢跑，预测出的 5k 也会很慢 (VDOT 就低) —— 这没关系，我们后面只取最大值
-    predicted_5k_min = duration_min * (5 / distance_km) ** 1.06
+    # 如果你是慢跑，预测出的 5k 也会很慢 (VDOT 就低) —— 这没关系，我们后面只取最快的那一次
+    pred[valid] = t[valid] * (5 / d[valid]) ** 1.06
+    return pred
+
+def vdot_from_5k(predicted_5k_min):
+    """
+    🧪 核心算法第二步：由 5km 成绩计算 VDOT (Daniels 近似公式)，inf 返回 0
+    VDOT 随 5km 用时单调递减，所以 "窗口内最大 VDOT" 就等于 "窗口内最快 5km 对应的 VDOT"，
+    只需对最快的那一次求值。
+    """
+    p = np.asarray(predicted_5k_min, dtype=float)
+    vdot = np.zeros(p.shape)
+    valid = np.isfinite(p)
     
     # 3. 计算 VDOT (基于 5km 成绩的回归公式)
     # 速度 (米/分)
-    v = 5000 / predicted_5k_min
+    v = 5000 / p[valid]
     
     # 丹尼尔斯氧气成本公式 (Oxygen Cost)
     # VDOT ~= VO2max / drop_off_percent
     # 这里使用一个高精度的拟合公式直接算 VDOT
     # 来源：Running formulas regression
-    vdot = -4.6 + 0.182258 * v + 0.000104 * v**2
+    vdot[valid] = np.round(-4.6 + 0.182258 * v + 0.000104 * v**2, 1)
     
-    return round(vdot, 1)
+    # 慢到公式算出负数的也记为 0 (和 "没有有效跑步" 一样)
+    return np.maximum(vdot, 0)
 
 def get_current_vdot(df, end_date, window_days=42):
     """
@@ -100,32 +139,20 @@ def get_current_vdot(df, end_date, window_days=42):
     if window_df.empty:
         return 0
     
-    # 计算每一单的 VDOT
-    vdot_values = []
-    for _, row in window_df.iterrows():
-        # 容错处理
-        try:
-            d = float(row['Distance (km)'])
-            t = float(row['Duration (min)'])
-            v = calculate_run_vdot(d, t)
-            if v > 0: vdot_values.append(v)
-        except: continue
-        
-    if not vdot_values: return 0
+    # 一次性算出窗口内每一单的 5km 等效成绩 (容错：无法解析的数值视为无效)，只对最快的一次求 VDOT
+    best_5k = predict_5k_min(
+        pd.to_numeric(window_df['Distance (km)'], errors='coerce'),
+        pd.to_numeric(window_df['Duration (min)'], errors='coerce')
+    ).min()
     
-    # 关键：取最大值 (代表你的潜能上限)
-    return max(vdot_values)
-def parse_pace_to_speed(pace_str):
-    """辅助：把 5'30" 转成 速度值 (km/h 或 m/s 均可，这里用 m/s)"""
-    try:
-        if not isinstance(pace_str, str): return 0
-        mins = int(pace_str.split("'")[0])
-        secs = int(pace_str.split("'")[1].replace('"',''))
-        total_sec = mins * 60 + secs
-        if total_sec == 0: return 0
-        return 1000 / total_sec # m/s
-    except:
-        return 0
+    # 关键：最快的 5km 对应最大 VDOT (代表你的潜能上限)
+    best = vdot_from_5k(best_5k)
+    return float(best) if best > 0 else 0
+
+def pace_series_to_sec(pace_series):
+    """辅助：把一整列 5'30" 批量转成秒数，无法解析的记为 0"""
+    parts = pace_series.astype(str).str.extract(PACE_RE)
+    return parts[0].astype(float).fillna(0) * 60 + parts[1].astype(float).fillna(0)
 
 def calculate_decoupling(splits_json):
     """
@@ -139,15 +166,15 @@ def calculate_decoupling(splits_json):
         
         # 简单的切分：前半程 vs 后半程
         half_idx = len(splits) // 2
-        first_half = splits[:half_idx]
-        second_half = splits[half_idx:]
         
-        # 计算两段的平均速度和平均心率
-        v1 = np.mean([parse_pace_to_speed(s['pace']) for s in first_half])
-        h1 = np.mean([s['hr'] for s in first_half])
+        # 一次性把配速转成速度 (m/s)：无法解析的配速速度记为 0
+        pace_sec = pace_series_to_sec(pd.Series([s['pace'] for s in splits])).to_numpy()
+        speeds = np.divide(1000, pace_sec, out=np.zeros_like(pace_sec), where=pace_sec > 0)
+        hrs = np.array([s['hr'] for s in splits], dtype=float)
         
-        v2 = np.mean([parse_pace_to_speed(s['pace']) for s in second_half])
-        h2 = np.mean([s['hr'] for s in second_half])
+        # 计算两段的平均速度和平均心率
+        v1, h1 = speeds[:half_idx].mean(), hrs[:half_idx].mean()
+        v2, h2 = speeds[half_idx:].mean(), hrs[half_idx:].mean()
         
         if h1 == 0 or h2 == 0: return None
         
@@ -161,6 +188,29 @@ def calculate_decoupling(splits_json):
         
     except Exception as e:
         return None
+def ewma_last(values, span):
+    """
+    📉 计算 EWMA (等价于 ewm(span, adjust=False)) 的最后一个值
+    只取尾部 5×span 天：更早的数据权重 < (1-α)^(5×span) ≈ e^-10，可以忽略。
+    递推展开为点积：s = (1-α)^(n-1)·x0 + Σ α(1-α)^(n-1-i)·xi
+    """
+    tail = np.asarray(values, dtype=float)[-5 * span:]
+    if tail.size == 0:
+        return 0.0
+    alpha = 2 / (span + 1)
+    weights = alpha * (1 - alpha) ** np.arange(tail.size - 1, -1, -1)
+    weights[0] = (1 - alpha) ** (tail.size - 1)
+    return float(weights @ tail)
+
+def values_to_df(values):
+    """🧾 把表格读出的原始二维数组 (首行为表头) 转成 DataFrame"""
+    if not values:
+        return pd.DataFrame()
+    header = values[0]
+    # API 会省略行尾的空单元格，这里补齐成和表头一样宽
+    rows = [row[:len(header)] + [''] * (len(header) - len(row)) for row in values[1:]]
+    return pd.DataFrame(rows, columns=header)
+
 # ... main 函数 ...
 def main():
     print("🚀 开始执行周报分析 (AI Analyst)...")
@@ -168,21 +218,33 @@ def main():
     if not client: return
 
     try:
-        sh = client.open(SHEET_NAME)
+        sh = open_spreadsheet(client)
     except Exception as e:
         print(f"❌ 找不到表格 '{SHEET_NAME}': {e}")
         return
 
     # 1. 读取运动数据
+    # 一次 batchGet 请求同时拉取 运动数据 / Settings / Weekly_Report 三张表
     print("📥 读取运动数据...")
     try:
-        worksheet = sh.sheet1
-        df = pd.DataFrame(worksheet.get_all_records())
-        # 清洗 Activity ID 列，防止科学计数法干扰
-        if 'Activity ID' in df.columns:
-             df['Activity ID'] = df['Activity ID'].astype(str)
-        df['Date'] = pd.to_datetime(df['Date'])
-        df = df.sort_values('Date') # 按时间正序排列
+        worksheets = {ws.title: ws for ws in sh.worksheets()}
+        titles = [next(iter(worksheets))] # 第一个工作表 (sheet1) 是运动数据
+        titles += [t for t in ('Settings', 'Weekly_Report') if t in worksheets]
+        # Weekly_Report 只用来查重，读 A 列就够了
+        res = sh.values_batch_get(
+            [f"'{t}'!A:A" if t == 'Weekly_Report' else f"'{t}'!A:Z" for t in titles],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'FORMATTED_STRING'}
+        )
+        tables = {t: vr.get('values', []) for t, vr in zip(titles, res['valueRanges'])}
+
+        df = values_to_df(tables[titles[0]])
+        # 整列转换类型：空单元格/异常值变成 NaN
+        num_cols = ['Distance (km)', 'Duration (min)', 'Avg HR']
+        df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce')
+        # Date 由同步脚本按 ISO 格式写入，整列一次解析，跳过逐行格式推断
+        df['Date'] = pd.to_datetime(df['Date'], format='ISO8601')
+        # 表中间的空行读出来是 NaT，merge_asof 不接受空键，直接丢掉
+        df = df.dropna(subset=['Date']).sort_values('Date') # 按时间正序排列
     except Exception as e:
         print(f"❌ 读取数据失败: {e}")
         return
@@ -190,8 +252,7 @@ def main():
     # 2. 读取心率设置
     print("⚙️ 读取用户配置...")
     try:
-        settings_ws = sh.worksheet('Settings')
-        settings_df = pd.DataFrame(settings_ws.get_all_records())
+        settings_df = values_to_df(tables['Settings'])
         settings_df['Date'] = pd.to_datetime(settings_df['Date'], errors='coerce')
         settings_df = settings_df.dropna(subset=['Date']).sort_values('Date')
         
@@ -203,28 +264,16 @@ def main():
 
     # 3. 计算 TRIMP
     print("🧮 计算每一单的训练负荷 (TRIMP)...")
-    trimp_list = []
-    for _, row in df.iterrows():
-        max_hr, rest_hr = get_hr_params(row['Date'], settings_df)
-        
-        # 数据容错处理
-        try:
-            avg_hr = pd.to_numeric(row['Avg HR'], errors='coerce')
-            duration = pd.to_numeric(row['Duration (min)'], errors='coerce')
-            
-            if pd.isna(avg_hr) or pd.isna(duration) or duration == 0 or avg_hr == 0:
-                trimp_list.append(0)
-                continue
-                
-            hrr = (avg_hr - rest_hr) / (max_hr - rest_hr)
-            hrr = max(0, min(1, hrr)) # 限制在 0-1
-            weight = 0.64 * np.exp(1.92 * hrr) # 男性系数
-            trimp = duration * hrr * weight
-            trimp_list.append(round(trimp, 1))
-        except:
-            trimp_list.append(0)
-    
-    df['TRIMP'] = trimp_list
+    max_hrs, rest_hrs = get_hr_params(df['Date'], settings_df)
+
+    # 数据容错处理：无效心率/时长记为 0
+    avg_hr = df['Avg HR'].to_numpy(dtype=float)
+    duration = df['Duration (min)'].to_numpy(dtype=float)
+    valid = (avg_hr > 0) & (duration > 0)
+
+    hrr = np.clip((avg_hr - rest_hrs) / (max_hrs - rest_hrs), 0, 1) # 限制在 0-1
+    weight = 0.64 * np.exp(1.92 * hrr) # 男性系数
+    df['TRIMP'] = np.where(valid, np.round(duration * hrr * weight, 1), 0)
 
     # 4. 生成周报 (本周概览)
     today = datetime.now()
@@ -238,12 +287,15 @@ def main():
     weekly_data = df[mask]
     
     # 计算 TSB (状态) - 基于长期数据
-    # 构建每日时间序列来计算移动平均
-    daily_load = df.set_index('Date').resample('D')['TRIMP'].sum().fillna(0)
+    # 按天汇总 TRIMP，只补齐尾部 5×42 天 (更早的数据对 EWMA 已无影响)
+    daily_sum = df.groupby(df['Date'].dt.normalize())['TRIMP'].sum()
+    last_day = daily_sum.index.max()
+    first_day = max(daily_sum.index.min(), last_day - timedelta(days=5 * 42 - 1))
+    daily_load = daily_sum.reindex(pd.date_range(first_day, last_day, freq='D'), fill_value=0)
     
     # 截止到昨天的 CTL 和 ATL
-    current_ctl = daily_load.ewm(span=42, adjust=False).mean().iloc[-1]
-    current_atl = daily_load.ewm(span=7, adjust=False).mean().iloc[-1]
+    current_ctl = ewma_last(daily_load, span=42)
+    current_atl = ewma_last(daily_load, span=7)
     current_tsb = current_ctl - current_atl
     
     # 🆕 计算本周生效的 VDOT (基于过去 6 周的最佳表现)
@@ -268,18 +320,9 @@ def main():
         
     # 准备周报行数据
     # 平均配速计算需要把 "5'30"" 转成秒
-    def parse_pace(p_str):
-        try:
-            if not isinstance(p_str, str): return 0
-            mins = int(p_str.split("'")[0])
-            secs = int(p_str.split("'")[1].replace('"',''))
-            return mins * 60 + secs
-        except:
-            return 0
-            
     avg_pace_sec = 0
     if len(weekly_data) > 0:
-        total_sec = weekly_data['Avg Pace'].apply(parse_pace).sum()
+        total_sec = pace_series_to_sec(weekly_data['Avg Pace']).sum()
         avg_pace_sec = total_sec / len(weekly_data)
         
     pace_fmt = f"{int(avg_pace_sec // 60)}'{int(avg_pace_sec % 60):02d}\"" if avg_pace_sec > 0 else "-"
@@ -305,29 +348,25 @@ def main():
         # -------------------------------------------------------
         # 修复逻辑：尝试获取 'Weekly_Report'，如果不存在才新建
         # -------------------------------------------------------
-        try:
-            # 尝试直接读取名为 Weekly_Report 的工作表
-            report_ws = sh.worksheet("Weekly_Report")
-        except gspread.WorksheetNotFound:
-            # 如果报错说找不到（WorksheetNotFound），说明是第一次运行，则新建它
+        if "Weekly_Report" in worksheets:
+            # 直接使用名为 Weekly_Report 的工作表
+            report_ws = worksheets["Weekly_Report"]
+            rows_to_append = [report_row]
+        else:
+            # 如果找不到，说明是第一次运行，则新建它
             report_ws = sh.add_worksheet(title="Weekly_Report", rows=100, cols=20)
-            # 初始化表头 (新建的时候才需要写表头)
+            # 初始化表头 (新建的时候才需要写表头，和数据行一次写入)
             headers = ["Week Start", "Week End", "Distance (km)", "Runs", "Avg Pace", 
                    "Weekly Load", "Fitness (CTL)", "Form (TSB)", "VDOT", 
                    "LSD Decouple", "Status"]
-            report_ws.append_row(headers)
+            rows_to_append = [headers, report_row]
         # -------------------------------------------------------
             
-        # 检查是否已经写过这一周（防止重复写入）
-        existing_reports = report_ws.get_all_values()
-        is_duplicate = False
-        for row in existing_reports:
-            if len(row) > 0 and row[0] == report_row[0]:
-                is_duplicate = True
-                break
+        # 检查是否已经写过这一周（防止重复写入），只需要 A 列的 Week Start
+        existing_starts = {str(row[0]) for row in tables.get("Weekly_Report", []) if row}
         
-        if not is_duplicate:
-            report_ws.append_row(report_row)
+        if report_row[0] not in existing_starts:
+            report_ws.append_rows(rows_to_append)
             print("✅ 周报已写入 Google Sheets")
         else:
             print("⚠️ 本周周报已存在，跳过写入")
@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 
 # --- 📱 页面配置 (移动端优化) ---
 st.set_page_config(
@@ -40,34 +40,33 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-# --- 1. 数据加载函数 (保持不变) ---
+# --- 1. 数据加载函数 ---
+@st.cache_resource
+def get_spreadsheet():
+    """🔑 认证并打开表格：整个 Streamlit 进程只做一次，所有会话共用"""
+    scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+    creds_dict = dict(st.secrets["gcp_service_account"])
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    client = gspread.authorize(creds)
+    # 配置了 sheet_id 就按 ID 打开，省去一次 Drive 按名称搜索
+    sheet_id = st.secrets.get("sheet_id")
+    return client.open_by_key(sheet_id) if sheet_id else client.open("Coros_Running_Data")
+
 @st.cache_data(ttl=600)
 def load_data():
     try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds_dict = {
-            "type": st.secrets["gcp_service_account"]["type"],
-            "project_id": st.secrets["gcp_service_account"]["project_id"],
-            "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-            "private_key": st.secrets["gcp_service_account"]["private_key"],
-            "client_email": st.secrets["gcp_service_account"]["client_email"],
-            "client_id": st.secrets["gcp_service_account"]["client_id"],
-            "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-            "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"]
-        }
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        sheet = client.open("Coros_Running_Data")
+        sheet = get_spreadsheet()
         report_ws = sheet.worksheet("Weekly_Report")
-        report_df = pd.DataFrame(report_ws.get_all_records())
+        values = report_ws.get_all_values()
+        report_df = pd.DataFrame(values[1:], columns=values[0])
         
-        # 数据类型清洗
+        # 数据类型清洗 (整列转换，空单元格变成 NaN)
         cols_to_num = ['VDOT', 'Fitness (CTL)', 'Form (TSB)', 'Distance (km)', 'Weekly Load']
-        for col in cols_to_num:
-            if col in report_df.columns:
-                report_df[col] = pd.to_numeric(report_df[col], errors='coerce')
+        present = [col for col in cols_to_num if col in report_df.columns]
+        report_df[present] = report_df[present].apply(pd.to_numeric, errors='coerce')
+        # 状态只有 恢复/适中/疲劳 三种取值
+        if 'Status' in report_df.columns:
+            report_df['Status'] = report_df['Status'].astype('category')
         
         return report_df
     except Exception as e:
@@ -1,126 +1,116 @@
 import pandas as pd
 import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
+from google.oauth2.service_account import Credentials
 import os
+import re
 import json
-import time
 
 # --- 配置 ---
 JSON_KEY = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
 SHEET_NAME = 'Coros_Running_Data'
+SHEET_ID = os.getenv('COROS_SHEET_ID') # 可选：表格 ID (URL 中 /d/ 后面那一段)
+# 配速格式 5'30"：分钟 + 秒
+PACE_RE = re.compile(r"^\s*(\d+)'(\d+)\"?\s*$")
 
 def get_client():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
     if not JSON_KEY:
         print("❌ 错误：未找到 Google Credentials")
         return None
     try:
         creds_dict = json.loads(JSON_KEY)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
         return gspread.authorize(creds)
     except Exception as e:
         print(f"❌ 认证失败: {e}")
         return None
 
+def open_spreadsheet(client):
+    """📂 优先按 ID 打开表格 (省去一次 Drive 按名称搜索)，未配置 ID 时按名称查找"""
+    if SHEET_ID:
+        return client.open_by_key(SHEET_ID)
+    return client.open(SHEET_NAME)
+
 def validate_settings(settings_df):
+    # 只有表头、没有设置行时 all() 对空列恒为 True，要单独判为无效
+    if settings_df.empty: return False
     try:
         if not pd.to_numeric(settings_df['Max HR'], errors='coerce').notnull().all(): return False
         if not pd.to_numeric(settings_df['Rest HR'], errors='coerce').notnull().all(): return False
     except: return False
     return True
 
-def get_hr_params_vectorized(dates, settings_df):
+def get_hr_params_vectorized(dates_sorted, settings_sorted_df):
     """
     ⚡️ 向量化加速版心率匹配：
     不再一行行查，而是利用 Pandas 的 merge_asof 快速匹配最近的设置
+    前提：两个输入都已按时间正序排列 (main 里读取时已经排好)，这里不再重复排序
     """
-    # 确保都按时间排序
-    dates = pd.DataFrame({'Date': dates}).sort_values('Date')
-    settings = settings_df.sort_values('Date')
+    dates = dates_sorted.to_frame(name='Date')
+    
+    # 如果有些早期跑步日期比第一条设置还早，用第一条设置：
+    # 在最前面垫一条 1970 年的哨兵记录 (复制第一条)，merge_asof 就永远不会匹配不到
+    sentinel = settings_sorted_df.iloc[:1].copy()
+    sentinel['Date'] = pd.Timestamp('1970-01-01')
+    settings = pd.concat([sentinel, settings_sorted_df], ignore_index=True)
     
     # asof merge: 找到 <= 跑步日期的最近一条设置
     merged = pd.merge_asof(dates, settings, on='Date', direction='backward')
-    
-    # 如果有些早期跑步日期比第一条设置还早，填充第一条设置
-    if merged['Max HR'].isnull().any():
-        first_setting = settings.iloc[0]
-        merged['Max HR'] = merged['Max HR'].fillna(first_setting['Max HR'])
-        merged['Rest HR'] = merged['Rest HR'].fillna(first_setting['Rest HR'])
         
     return merged['Max HR'].values, merged['Rest HR'].values
 # ... import 部分保持不变 ...
 
-def calculate_run_vdot(distance_km, duration_min):
+def predict_5k_min(distance_km, duration_min):
     """
-    🧪 核心算法：估算单次跑步的 VDOT
-    逻辑：先利用 Riegel 公式将本次表现归一化为 "5km 等效成绩"，
-    再利用 Daniels 近似公式计算 VDOT。
+    🧪 核心算法第一步：用 Riegel 公式把每次跑步归一化为 "5km 等效成绩" (分钟)
+    无效数据返回 inf，这样取最小值时自然被忽略。
     """
-    # 1. 过滤无效数据：距离太短或太长都不准，配速太慢也不算
-    if distance_km < 3 or duration_min <= 0: return 0
+    d = np.asarray(distance_km, dtype=float)
+    t = np.asarray(duration_min, dtype=float)
+    pred = np.full(d.shape, np.inf)
+
+    # 1. 过滤无效数据：距离太短或太长都不准，配速太慢也不算 (NaN 比较结果为 False)
+    valid = (d >= 3) & (t > 0)
     
     # 2. Riegel 公式归一化到 5km (预测尽力跑 5km 的用时)
     # T2 = T1 * (D2 / D1)^1.06
     # 这里的假设是：如果你这次跑得很快，Riegel 会预测出一个很快的 5k
-    # 如果你是慢跑，预测出的 5k 也会很慢 (VDOT 就低) —— 这没关系，我们后面只取最大值
-    predicted_5k_min = duration_min * (5 / distance_km) ** 1.06
+    # 如果你是慢跑，预测出的 5k 也会很慢 (VDOT 就低) —— 这没关系，我们后面只取最快的那一次
+    pred[valid] = t[valid] * (5 / d[valid]) ** 1.06
+    return pred
+
+def vdot_from_5k(predicted_5k_min):
+    """
+    🧪 核心算法第二步：由 5km 成绩计算 VDOT (Daniels 近似公式)，inf 返回 0
+    VDOT 随 5km 用时单调递减，所以 "窗口内最大 VDOT" 就等于 "窗口内最快 5km 对应的 VDOT"，
+    只需对最快的那一次求值。
+    """
+    p = np.asarray(predicted_5k_min, dtype=float)
+    vdot = np.zeros(p.shape)
+    valid = np.isfinite(p)
     
     # 3. 计算 VDOT (基于 5km 成绩的回归公式)
     # 速度 (米/分)
-    v = 5000 / predicted_5k_min
+    v = 5000 / p[valid]
     
     # 丹尼尔斯氧气成本公式 (Oxygen Cost)
     # VDOT ~= VO2max / drop_off_percent
     # 这里使用一个高精度的拟合公式直接算 VDOT
     # 来源：Running formulas regression
-    vdot = -4.6 + 0.182258 * v + 0.000104 * v**2
-    
-    return round(vdot, 1)
-
-def get_current_vdot(df, end_date, window_days=42):
-    """
-    📅 获取截止到 end_date 的‘当前跑力’
-    逻辑：回溯过去 window_days (默认6周) 内所有跑步记录，
-    取其中计算出的【最大 VDOT 值】。
-    """
-    start_date = end_date - timedelta(days=window_days)
-    
-    # 筛选时间窗口内的数据
-    mask = (df['Date'] >= start_date) & (df['Date'] <= end_date)
-    window_df = df[mask]
-    
-    if window_df.empty:
-        return 0
-    
-    # 计算每一单的 VDOT
-    vdot_values = []
-    for _, row in window_df.iterrows():
-        # 容错处理
-        try:
-            d = float(row['Distance (km)'])
-            t = float(row['Duration (min)'])
-            v = calculate_run_vdot(d, t)
-            if v > 0: vdot_values.append(v)
-        except: continue
-        
-    if not vdot_values: return 0
+    vdot[valid] = np.round(-4.6 + 0.182258 * v + 0.000104 * v**2, 1)
     
-    # 关键：取最大值 (代表你的潜能上限)
-    return max(vdot_values)
+    # 慢到公式算出负数的也记为 0 (和 "没有有效跑步" 一样)
+    return np.maximum(vdot, 0)
     
 def parse_pace_to_speed(pace_str):
     """辅助：把 5'30" 转成 速度值 (km/h 或 m/s 均可，这里用 m/s)"""
-    try:
-        if not isinstance(pace_str, str): return 0
-        mins = int(pace_str.split("'")[0])
-        secs = int(pace_str.split("'")[1].replace('"',''))
-        total_sec = mins * 60 + secs
-        if total_sec == 0: return 0
-        return 1000 / total_sec # m/s
-    except:
-        return 0
+    if not isinstance(pace_str, str): return 0
+    m = PACE_RE.match(pace_str)
+    if not m: return 0
+    total_sec = int(m.group(1)) * 60 + int(m.group(2))
+    if total_sec == 0: return 0
+    return 1000 / total_sec # m/s
 
 def calculate_decoupling(splits_json):
     """
@@ -162,21 +152,28 @@ def main():
     print("🚀 启动历史周报回溯生成器 (History Backfill)...")
     client = get_client()
     if not client: return
-    sh = client.open(SHEET_NAME)
+    sh = open_spreadsheet(client)
+    # 一次性取回所有工作表，后面按名称直接使用，不再逐个查询元数据
+    worksheets = {ws.title: ws for ws in sh.worksheets()}
 
     # 1. 读取数据
     print("📥 读取所有运动数据...")
-    df = pd.DataFrame(sh.sheet1.get_all_records())
-    if 'Activity ID' in df.columns:
-         df['Activity ID'] = df['Activity ID'].astype(str)
-    df['Date'] = pd.to_datetime(df['Date'])
+    values = next(iter(worksheets.values())).get_all_values()
+    df = pd.DataFrame(values[1:], columns=values[0])
+    # 整列转换数值类型：空单元格/异常值变成 NaN
+    num_cols = ['Distance (km)', 'Duration (min)', 'Avg HR']
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce')
+    # Date 由同步脚本按 ISO 格式写入，整列一次解析，跳过逐行格式推断
+    df['Date'] = pd.to_datetime(df['Date'], format='ISO8601')
     df = df.sort_values('Date')
 
     # 2. 读取设置
     print("⚙️ 读取设置...")
     try:
-        settings_ws = sh.worksheet('Settings')
-        settings_df = pd.DataFrame(settings_ws.get_all_records())
+        settings_ws = worksheets['Settings']
+        settings_values = settings_ws.get_all_values()
+        settings_df = pd.DataFrame(settings_values[1:], columns=settings_values[0])
+        settings_df[['Max HR', 'Rest HR']] = settings_df[['Max HR', 'Rest HR']].apply(pd.to_numeric, errors='coerce')
         settings_df['Date'] = pd.to_datetime(settings_df['Date'], errors='coerce')
         settings_df = settings_df.dropna(subset=['Date']).sort_values('Date')
         if not validate_settings(settings_df): raise ValueError
@@ -187,18 +184,17 @@ def main():
     # 3. 批量计算 TRIMP
     print("🧮 批量计算 TRIMP...")
     # 清洗数据
-    df['Avg HR'] = pd.to_numeric(df['Avg HR'], errors='coerce').fillna(0)
-    df['Duration (min)'] = pd.to_numeric(df['Duration (min)'], errors='coerce').fillna(0)
+    df[['Avg HR', 'Duration (min)']] = df[['Avg HR', 'Duration (min)']].fillna(0)
     
     # 获取对应的 Max/Rest HR
     max_hrs, rest_hrs = get_hr_params_vectorized(df['Date'], settings_df)
     
-    # 向量化计算
-    hrr = (df['Avg HR'] - rest_hrs) / (max_hrs - rest_hrs)
-    hrr = hrr.clip(0, 1)
-    weight = 0.64 * np.exp(1.92 * hrr)
-    df['TRIMP'] = df['Duration (min)'] * hrr * weight
-    df['TRIMP'] = df['TRIMP'].fillna(0).round(1)
+    # 向量化计算 (直接用 NumPy 数组，原地运算减少临时数组)
+    hrr = np.clip((df['Avg HR'].to_numpy(dtype=float) - rest_hrs) / (max_hrs - rest_hrs), 0, 1)
+    trimp = df['Duration (min)'].to_numpy(dtype=float) * hrr
+    trimp *= 0.64 * np.exp(1.92 * hrr)
+    trimp[np.isnan(trimp)] = 0
+    df['TRIMP'] = np.round(trimp, 1)
 
     # 4. 构建每日时间序列 (为了计算连续的 CTL/ATL)
     print("📈 重建每日时间轴 & 计算状态指数...")
@@ -206,19 +202,18 @@ def main():
     end_date = df['Date'].max().normalize()
     all_days = pd.date_range(start_date, end_date, freq='D')
     
-    # 按天汇总 TRIMP (防止一天多跑)
-    daily_trimp = df.set_index('Date').resample('D')['TRIMP'].sum().reindex(all_days, fill_value=0)
+    # 按天汇总 TRIMP (防止一天多跑)，直接按日期分组，免去 set_index 整表复制
+    run_day = df['Date'].dt.normalize()
+    daily_trimp = df.groupby(run_day)['TRIMP'].sum().reindex(all_days, fill_value=0)
     
     # 计算 CTL, ATL, TSB
     ctl = daily_trimp.ewm(span=42, adjust=False).mean()
     atl = daily_trimp.ewm(span=7, adjust=False).mean()
-    tsb = ctl - atl
     
-    # 组合成每日状态表
+    # 组合成每日状态表 (只保留周报要用的两列，周采样时少搬一列数据)
     daily_stats = pd.DataFrame({
-        'TRIMP': daily_trimp,
         'CTL': ctl,
-        'TSB': tsb
+        'TSB': ctl - atl
     })
 
     # 5. 按周重新采样 (Resample Weekly)
@@ -227,116 +222,108 @@ def main():
     # 这一周的总跑量、总负荷，以及这一周【结束时】的状态(TSB)
     print("📅 按周汇总数据...")
     
-    # 辅助函数：计算平均配速
-    def avg_pace_calc(series):
-        total_sec = 0
-        count = 0
-        for p_str in series:
-            try:
-                if isinstance(p_str, str) and "'" in p_str:
-                    mins = int(p_str.split("'")[0])
-                    secs = int(p_str.split("'")[1].replace('"',''))
-                    total_sec += mins * 60 + secs
-                    count += 1
-            except: pass
-        return total_sec / count if count > 0 else 0
+    # 平均配速：整列一次性把 5'30" 转成秒数，无法解析的为 NaN (不参与平均)
+    pace_parts = df['Avg Pace'].astype(str).str.extract(PACE_RE)
+    df['PaceSec'] = pd.to_numeric(pace_parts[0]) * 60 + pd.to_numeric(pace_parts[1])
 
     # 聚合逻辑
     weekly_agg = df.set_index('Date').resample('W-SUN').agg({
         'Distance (km)': 'sum',
         'Activity ID': 'count', # 次数
         'TRIMP': 'sum',
-        'Avg Pace': avg_pace_calc # 自定义聚合
+        'PaceSec': 'mean'
     })
+    weekly_agg['PaceSec'] = weekly_agg['PaceSec'].fillna(0)
     
     # 把 TSB/CTL 也按周取样（取每周日的那个值）
     weekly_status = daily_stats.resample('W-SUN').last()
     
     # 合并
-    final_report = pd.concat([weekly_agg, weekly_status[['CTL', 'TSB']]], axis=1)
+    final_report = pd.concat([weekly_agg, weekly_status], axis=1)
+    
+    # 🆕 VDOT：一次性算出每一单的 5km 等效成绩，按天求 42 天滚动最小值，
+    # 最后只对每周最快的那个成绩求 VDOT (代表你的潜能上限)
+    # 每周的窗口是 [周日标签-42天, 周日 0 点]，也就是周日之前的 42 个自然日，再加上正好周日 0 点的那一单
+    df['Pred5k'] = predict_5k_min(df['Distance (km)'], df['Duration (min)'])
+    vdot_days = pd.date_range(start_date, final_report.index.max(), freq='D')
+    daily_5k = df.groupby(run_day)['Pred5k'].min().reindex(vdot_days, fill_value=np.inf)
+    at_midnight = df['Date'] == run_day
+    midnight_5k = df.loc[at_midnight, 'Pred5k'].groupby(run_day[at_midnight]).min().reindex(vdot_days, fill_value=np.inf)
+    best_5k_42d = np.minimum(daily_5k.rolling('42D').min().shift(1, fill_value=np.inf), midnight_5k)
+    final_report['VDOT'] = vdot_from_5k(best_5k_42d.reindex(final_report.index))
+    
+    # 整列格式化配速，并按 TSB 判定状态
+    pace_sec = final_report['PaceSec']
+    pace_str = (pace_sec // 60).astype(int).astype(str) + "'" + (pace_sec % 60).astype(int).astype(str).str.zfill(2) + '"'
+    final_report['PaceFmt'] = np.where(pace_sec > 0, pace_str, "-")
+    tsb = final_report['TSB']
+    final_report['Status'] = np.select([tsb > 10, tsb > -10], ["恢复", "适中"], default="疲劳")
+    
+    # 🆕 LSD：一次分组找出每周最长的一单，代替每周一次的全表布尔筛选
+    # 周窗口为 [周一 0 点, 周日 0 点]，与上面的周日标签对齐
+    week_key = run_day + pd.to_timedelta(6 - df['Date'].dt.weekday, unit='D')
+    in_window = (df['Date'].dt.weekday < 6) | (df['Date'] == run_day)
+    longest_by_week = df.loc[in_window, 'Duration (min)'].groupby(week_key[in_window]).idxmax()
     
     # 6. 准备写入数据
     print("📝 准备写入数据...")
-    rows_to_write = []
     
     # 🆕 表头增加 VDOT
     headers = ["Week Start", "Week End", "Distance (km)", "Runs", "Avg Pace", "Weekly Load", "Fitness (CTL)", "Form (TSB)", "VDOT", "LSD Decouple", "Status"]
     
-    for date_idx, row in final_report.iterrows():
-        # 如果这一周没有任何数据且 TSB 还没建立起来，跳过
-        if row['Distance (km)'] == 0 and row['CTL'] < 1:
-            continue
+    # 如果这一周没有任何数据且 TSB 还没建立起来，跳过
+    report = final_report[~((final_report['Distance (km)'] == 0) & (final_report['CTL'] < 1))]
+    
+    # 计算每周长距离跑 (LSD) 的脱钩率：只需要解析每周最长那一单的分段
+    lsd_decouple = pd.Series("-", index=report.index, dtype=object)
+    for week_end, longest_idx in longest_by_week[longest_by_week.index.isin(report.index)].items():
+        try:
+            longest_run = df.loc[longest_idx]
             
-        week_end = date_idx
-        week_start = week_end - timedelta(days=6)
-        # 1. 计算这周结束时的 VDOT
-        current_vdot = get_current_vdot(df, week_end, window_days=42)
-        
-        # 2. 计算本周长距离跑 (LSD) 的脱钩率
-        lsd_decouple = "-"
-        
-        # 在原始 df 中，筛选出这一周的数据
-        mask_week = (df['Date'] >= week_start) & (df['Date'] <= week_end)
-        this_week_runs = df[mask_week]
-        
-        if not this_week_runs.empty:
-            # 找最长的一单 (Duration 最大)
-            # 使用 idxmax 找到索引，再提取行
-            try:
-                longest_idx = this_week_runs['Duration (min)'].idxmax()
-                longest_run = this_week_runs.loc[longest_idx]
-                
-                # 只有当长距离超过 30 分钟才计算
-                if pd.to_numeric(longest_run['Duration (min)']) > 30:
-                     # calculate_decoupling 可能会返回 None
-                     dc = calculate_decoupling(longest_run['Splits (JSON)'])
-                     
-                     # --- ⚠️ 之前报错就在这里，请注意缩进 ---
-                     if dc is not None:
-                         lsd_decouple = f"{dc}%" 
-                         # 这里的 lsd_decouple 必须比上面的 if 多 4 个空格
-            except Exception as e:
-                # 容错处理，防止某一行数据异常导致崩溃
-                print(f"计算脱钩率跳过: {e}")
-        
-        # 格式化配速
-        pace_sec = row['Avg Pace']
-        pace_fmt = f"{int(pace_sec // 60)}'{int(pace_sec % 60):02d}\"" if pace_sec > 0 else "-"
-        
-        current_tsb = row['TSB']
-        status_text = "恢复" if current_tsb > 10 else ("适中" if current_tsb > -10 else "疲劳")
-        
-        rows_to_write.append([
-            week_start.strftime("%Y-%m-%d"),
-            week_end.strftime("%Y-%m-%d"),
-            round(row['Distance (km)'], 2),
-            int(row['Activity ID']),
-            pace_fmt,
-            round(row['TRIMP']),
-            round(row['CTL'], 1),
-            round(row['TSB'], 1),
-            current_vdot, # <--- 填入数据
-            lsd_decouple, # <--- 插入这里
-            status_text
-        ])
+            # 只有当长距离超过 30 分钟才计算
+            if longest_run['Duration (min)'] > 30:
+                # calculate_decoupling 可能会返回 None
+                dc = calculate_decoupling(longest_run['Splits (JSON)'])
+                if dc is not None:
+                    lsd_decouple.loc[week_end] = f"{dc}%"
+        except Exception as e:
+            # 容错处理，防止某一行数据异常导致崩溃
+            print(f"计算脱钩率跳过: {e}")
+    
+    # 整列拼出输出表，再一次性 tolist 成原生 int/float/str 的二维列表
+    report_df = pd.DataFrame({
+        "Week Start": (report.index - pd.Timedelta(days=6)).strftime("%Y-%m-%d"),
+        "Week End": report.index.strftime("%Y-%m-%d"),
+        "Distance (km)": report['Distance (km)'].round(2),
+        "Runs": report['Activity ID'].astype(int),
+        "Avg Pace": report['PaceFmt'],
+        "Weekly Load": report['TRIMP'].round().astype(int),
+        "Fitness (CTL)": report['CTL'].round(1),
+        "Form (TSB)": report['TSB'].round(1),
+        "VDOT": report['VDOT'], # <--- 这周结束时的 VDOT
+        "LSD Decouple": lsd_decouple,
+        "Status": report['Status']
+    }, columns=headers)
+    rows_to_write = report_df.astype(object).values.tolist()
 
     # ... (写入 Google Sheets 保持不变) ...
 
     # 7. 写入 Google Sheets
     # 注意：这次是全量覆盖写入 Weekly_Report，防止重复和顺序混乱
     try:
-        try:
-            report_ws = sh.worksheet('Weekly_Report')
+        if 'Weekly_Report' in worksheets:
+            report_ws = worksheets['Weekly_Report']
             print("🧹 清空旧的 Weekly_Report...")
             report_ws.clear()
-        except:
+        else:
             print("✨ 新建 Weekly_Report 表...")
             report_ws = sh.add_worksheet(title="Weekly_Report", rows=len(rows_to_write)+20, cols=20)
             
         print(f"🚀 正在写入 {len(rows_to_write)} 周的历史报告...")
         # 加上表头
         all_content = [headers] + rows_to_write
-        report_ws.update(range_name='A1', values=all_content)
+        # 所有单元格已是原生 int/float/str；RAW：按原样写入，服务器不再逐格解析
+        report_ws.update(range_name='A1', values=all_content, value_input_option='RAW')
         print("✅ 历史回溯完成！")
         
     except Exception as e:
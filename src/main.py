@@ -1,9 +1,14 @@
 import os
 import json
-import time
-import pandas as pd
+import itertools
+import operator
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import requests
+from requests.adapters import HTTPAdapter
+from google.oauth2.service_account import Credentials
 from stravalib.client import Client
 
 # --- 配置部分 ---
@@ -12,11 +17,34 @@ STRAVA_CLIENT_SECRET = os.getenv('STRAVA_CLIENT_SECRET')
 STRAVA_REFRESH_TOKEN = os.getenv('STRAVA_REFRESH_TOKEN')
 GOOGLE_JSON_KEY = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
 SHEET_NAME = "Coros_Running_Data"
+SHEET_ID = os.getenv('COROS_SHEET_ID') # 可选：表格 ID，配置后按 ID 打开，省去 Drive 搜索
 BATCH_SIZE = 80 
+# 只能从表里推算水位线时：表里存的是本地时间，而 Strava 按 UTC 过滤 after/before，两边各留一天余量 (多拉到的由 existing_ids 去重)
+WATERMARK_MARGIN = timedelta(days=1)
+# 并发下载详情的线程数：耗时都在等 HTTP 响应，线程就够用；Strava 配额由 stravalib 自带的限速器按响应头控制
+MAX_WORKERS = 8
+# 本地同步状态文件 (已同步 ID + 水位线)，GitHub Actions 里用 actions/cache 在两次运行之间保留
+STATE_FILE = os.getenv('SYNC_STATE_FILE', 'sync_state.json')
+# 下载失败的活动最多尝试几次 (含第一次)，之后放弃，免得删掉的活动/坏数据每次都重拉
+MAX_ATTEMPTS = 3
+# 每批最多留给重试的名额，其余始终留给清单里新发现的活动
+RETRY_SLOTS = BATCH_SIZE // 4
+
+# 详情里可能缺失的字段：一次 attrgetter 取出，缺数据 (None) 时按默认值填
+_OPTIONAL_FIELDS = ('average_heartrate', 'max_heartrate', 'suffer_score', 'average_watts',
+                    'average_cadence', 'kilojoules', 'average_temp')
+_get_optionals = operator.attrgetter(*_OPTIONAL_FIELDS)
+
+def _get_with_defaults(detail):
+    """attrgetter 遇到缺属性的对象会报错，这时逐个取，缺的记为 None"""
+    return tuple(getattr(detail, field, None) for field in _OPTIONAL_FIELDS)
 
 def get_strava_client():
     if not STRAVA_REFRESH_TOKEN: return None
-    client = Client()
+    # 所有 API 请求共用一个会话：连接池大小与并发线程数一致，整批详情只需握手 MAX_WORKERS 次
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+    client = Client(requests_session=session)
     try:
         refresh_response = client.refresh_access_token(
             client_id=STRAVA_CLIENT_ID,
@@ -31,13 +59,14 @@ def get_strava_client():
 
 def get_google_sheet():
     if not GOOGLE_JSON_KEY: return None
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
     try:
         creds_dict = json.loads(GOOGLE_JSON_KEY)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
         client = gspread.authorize(creds)
         try:
-            sheet = client.open(SHEET_NAME).sheet1
+            sh = client.open_by_key(SHEET_ID) if SHEET_ID else client.open(SHEET_NAME)
+            sheet = sh.sheet1
             return sheet
         except gspread.exceptions.SpreadsheetNotFound:
             print(f"表格 '{SHEET_NAME}' 未找到，正在创建...")
@@ -57,22 +86,72 @@ def get_google_sheet():
 
 def get_pace_str(speed_mps):
     if not speed_mps or speed_mps <= 0: return "0'00\""
-    pace_decimal = (1000 / float(speed_mps)) / 60
-    pace_min = int(pace_decimal)
-    pace_sec = int((pace_decimal - pace_min) * 60)
+    # 先取每公里整秒数，再 divmod 拆成分/秒 (float() 兼容带单位的速度对象)
+    pace_min, pace_sec = divmod(int(1000 / float(speed_mps)), 60)
     return f"{pace_min}'{pace_sec:02d}\""
 
+@lru_cache(maxsize=None)
 def clean_id(val):
     """
     🛠️ 关键修复：清洗 ID
     不管是 12345 (int), '12345' (str), 还是 12345.0 (float)
-    统统转成纯字符串 '12345'
+    统统转成纯字符串 '12345' (结果会缓存，同一个 ID 只清洗一次)
     """
+    # 快速通道：整数和纯数字字符串不用走 float 转换
+    if isinstance(val, int):
+        return str(val)
+    s = str(val)
+    if s.isascii() and s.isdigit():
+        return s
     try:
         # 先转 float 处理 .0 的情况，再转 int 去掉小数，最后转 str
-        return str(int(float(val)))
-    except:
-        return str(val).strip()
+        return str(int(float(s)))
+    except (ValueError, OverflowError):
+        return s.strip()
+
+def load_state():
+    """📦 读取本地同步状态，不存在或损坏时返回 None (此时回退为读表)"""
+    try:
+        with open(STATE_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_state(row_count, data_rows, ids, after_epoch, before_epoch, date_range, failed_attempts):
+    """
+    💾 保存同步状态：表格行数 (用来校验表有没有被手动删行)、表头下面实际占用的行数 (含重复/空行，排序范围用)、
+    已同步 ID、新旧两头的水位线 (UTC 秒)，
+    表里第一行/最后一行的日期 (本地时间字符串，写入时用来判断新行该插在哪)，
+    以及下载失败待重试的 ID -> 已尝试次数 (水位线会越过它们，只能靠这份名单补回来)
+    """
+    state = {
+        "row_count": row_count,
+        "data_rows": data_rows,
+        "ids": sorted(ids),
+        "after": after_epoch,
+        "before": before_epoch,
+        "date_range": date_range,
+        "failed": dict(sorted(failed_attempts.items()))
+    }
+    try:
+        with open(STATE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    except OSError as e:
+        print(f"同步状态保存失败 (不影响数据，下次会重新读表): {e}")
+
+def to_epoch(dt):
+    """把 datetime 转成 UTC 秒；不带时区的按 UTC 处理 (和 stravalib 的约定一致)"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def to_cell(val):
+    """把一个 Python 值转成 Sheets API 的单元格结构 (等同 RAW：字符串原样保存，不解析公式/日期)"""
+    if val is None:
+        return {}
+    if isinstance(val, (int, float)):
+        return {"userEnteredValue": {"numberValue": val}}
+    return {"userEnteredValue": {"stringValue": str(val)}}
 
 def process_activity_detail(activity_id, client):
     try:
@@ -87,34 +166,42 @@ def process_activity_detail(activity_id, client):
         if hasattr(detail, 'splits_metric') and detail.splits_metric:
             for s in detail.splits_metric:
                 split_pace = get_pace_str(s.average_speed)
-                split_hr = s.average_heartrate if hasattr(s, 'average_heartrate') else 0
+                # 没戴心率带的分段 average_heartrate 为 None
+                split_hr = getattr(s, 'average_heartrate', None) or 0
                 splits_data.append({"km": s.split, "pace": split_pace, "hr": round(split_hr)})
-        splits_json = json.dumps(splits_data, ensure_ascii=False)
+        # 紧凑分隔符：不写多余空格，序列化更快、单元格也更小 (读取端用 json.loads，不受影响)
+        splits_json = json.dumps(splits_data, ensure_ascii=False, separators=(',', ':'))
 
         shoe_name = ""
         if detail.gear_id:
-            try:
-                shoe_name = detail.gear.name if hasattr(detail.gear, 'name') else detail.gear_id
-            except: pass
+            # 装备信息随详情一起返回，没有名称时退回 gear_id
+            shoe_name = getattr(detail.gear, 'name', None) or detail.gear_id
+
+        try:
+            avg_hr, max_hr, suffer, watts, cadence, kj, temp = _get_optionals(detail)
+        except AttributeError:
+            avg_hr, max_hr, suffer, watts, cadence, kj, temp = _get_with_defaults(detail)
 
         return [
             str(detail.id), # 写入时确保是字符串
-            detail.start_date_local.strftime("%Y-%m-%d %H:%M:%S"),
+            # 等价于 strftime("%Y-%m-%d %H:%M:%S")，但走 C 实现；去掉时区，避免带出 +00:00 后缀
+            detail.start_date_local.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds'),
             detail.name,
             dist_km,
             duration_min,
             avg_pace,
             max_pace,
-            detail.average_heartrate if detail.average_heartrate else 0,
-            detail.max_heartrate if detail.max_heartrate else 0,
-            detail.suffer_score if hasattr(detail, 'suffer_score') else 0,
-            detail.average_watts if hasattr(detail, 'average_watts') else 0,
-            (detail.average_cadence * 2) if detail.average_cadence else 0,
-            float(detail.total_elevation_gain),
-            detail.kilojoules if hasattr(detail, 'kilojoules') else 0,
-            detail.average_temp if hasattr(detail, 'average_temp') else "",
+            avg_hr or 0,
+            max_hr or 0,
+            suffer or 0,
+            watts or 0,
+            (cadence or 0) * 2,
+            float(detail.total_elevation_gain or 0), # 跑步机等没有海拔数据时为 None
+            kj or 0,
+            "" if temp is None else temp, # 0°C 是有效温度，不能用 or
             shoe_name,
-            detail.type,
+            # stravalib 2.x 的 type 是 RelaxedActivityType，直接 str() 会写成 "root='Run'"，这里取出里面的字符串
+            getattr(detail.type, 'root', detail.type),
             splits_json
         ]
     except Exception as e:
@@ -128,71 +215,195 @@ def main():
     
     if not strava or not sheet: return
 
-    # 1. 强健地读取已保存 ID
+    # 1. 强健地读取已保存 ID 和水位线
     existing_ids = set()
-    try:
-        records = sheet.get_all_records()
-        if records:
-            df = pd.DataFrame(records)
-            # 使用 clean_id 函数清洗每一行的 ID
-            df['Clean_ID'] = df['Activity ID'].apply(clean_id)
-            existing_ids = set(df['Clean_ID'].tolist())
-            print(f"📊 本地已有数据: {len(existing_ids)} 条 (已清洗格式)")
-    except Exception as e:
-        print(f"读取现有表格出错或为空: {e}")
+    data_rows = 0 # 表头下面实际占用的行数：表里可能有重复 ID 或空行，不能用 len(existing_ids) 代替
+    # 水位线 (UTC 秒)：只拉 after 之后的新活动和 before 之前待回溯的历史，None 表示空表
+    after_epoch = before_epoch = None
+    # 表里最新/最早一行的日期 (本地时间字符串)，None 表示不知道 (写入后退回为全表排序)
+    date_range = None
+    state = load_state()
+    # 上次下载失败的 ID -> 已尝试次数：表被改过、状态要重建时也保留，本次优先重试
+    failed_attempts = state.get('failed', {}) if state else {}
+    if isinstance(failed_attempts, list): # 旧版状态文件只存了 ID 列表
+        failed_attempts = dict.fromkeys(failed_attempts, 1)
+    # 表格行数是打开表格时就拿到的元数据，不用额外请求；对不上说明表被改过，回退为读表
+    if state and state.get('row_count') == sheet.row_count and 'data_rows' in state:
+        existing_ids = set(state['ids'])
+        data_rows = state['data_rows']
+        after_epoch, before_epoch = state.get('after'), state.get('before')
+        date_range = state.get('date_range')
+        print(f"📦 使用本地同步状态: {len(existing_ids)} 条，跳过读表")
+    else:
+        try:
+            saved_dates = []
+            # 只读 A、B 两列 (Activity ID + Date)，不必下载整张表；UNFORMATTED 避免大数字被显示成科学计数法
+            id_date_rows = sheet.get('A2:B', value_render_option='UNFORMATTED_VALUE')
+            # 读到的是第 2 行到最后一个非空行，中间的空行也算在内
+            data_rows = len(id_date_rows)
+            filled_rows = 0
+            for r in id_date_rows:
+                if not r: continue
+                filled_rows += 1
+                # 使用 clean_id 函数清洗每一行的 ID
+                existing_ids.add(clean_id(r[0]))
+                if len(r) > 1:
+                    try:
+                        saved_dates.append(datetime.fromisoformat(str(r[1])))
+                    except ValueError:
+                        pass
+            if existing_ids:
+                print(f"📊 本地已有数据: {len(existing_ids)} 条 (已清洗格式)")
+            if saved_dates:
+                after_epoch = to_epoch(max(saved_dates) - WATERMARK_MARGIN)
+                before_epoch = to_epoch(min(saved_dates) + WATERMARK_MARGIN)
+                # 每个非空行的日期都能解析，才知道表里的日期范围
+                if len(saved_dates) == filled_rows:
+                    date_range = [d.strftime("%Y-%m-%d %H:%M:%S") for d in (max(saved_dates), min(saved_dates))]
+            failed_attempts = {k: n for k, n in failed_attempts.items() if k not in existing_ids}
+            save_state(sheet.row_count, data_rows, existing_ids, after_epoch, before_epoch, date_range, failed_attempts)
+        except Exception as e:
+            print(f"读取现有表格出错或为空: {e}")
 
     # 2. 拉取清单
     print("☁️ 正在拉取 Strava 活动清单...")
     try:
-        summary_iterator = strava.get_activities(limit=3000) 
+        if after_epoch is not None:
+            # 有水位线：只拉比已同步最新一条更晚的 (新活动) 和比最早一条更早的 (待回溯的历史)
+            # 新活动按时间从旧到新处理，凑满一批时水位线只推进到这一批里最新的那条
+            new_summaries = sorted(
+                strava.get_activities(after=datetime.fromtimestamp(after_epoch, timezone.utc)),
+                key=lambda s: to_epoch(s.start_date)
+            )
+            old_summaries = strava.get_activities(before=datetime.fromtimestamp(before_epoch, timezone.utc))
+            summary_iterator = itertools.chain(new_summaries, old_summaries)
+        else:
+            # 空表：第一次运行，全量扫描
+            summary_iterator = strava.get_activities(limit=3000) 
         
-        to_sync_ids = []
-        for summary in summary_iterator:
-            if summary.type != "Run": continue
+        print("⚙️ 边扫描清单边下载详情...")
+        # 上次失败的先重试 (最多 RETRY_SLOTS 条)，剩下的名额留给清单里新发现的
+        retry_ids = sorted(failed_attempts)[:RETRY_SLOTS]
+        to_sync_ids = [int(act_id) for act_id in retry_ids]
+        start_epochs = {} # 新发现的活动 ID -> 开始时间 (UTC 秒)，用来推进水位线
+        seen_ids = existing_ids | failed_attempts.keys()
+        new_rows = []
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            futures = [pool.submit(process_activity_detail, act_id, strava) for act_id in to_sync_ids]
+            if retry_ids:
+                print(f"🔁 重试上次下载失败的 {len(retry_ids)} 条...")
+            for summary in summary_iterator:
+                if summary.type != "Run": continue
+                
+                # 使用同样的逻辑清洗 Strava 返回的 ID
+                strava_id_str = clean_id(summary.id)
+                
+                if strava_id_str not in seen_ids:
+                    to_sync_ids.append(summary.id) # 记录原始 ID 用于请求
+                    seen_ids.add(strava_id_str) # 余量区间内两头可能重复拉到同一条
+                    start_epochs[summary.id] = to_epoch(summary.start_date)
+                    # 一发现就提交下载，详情下载和清单翻页同时进行
+                    futures.append(pool.submit(process_activity_detail, summary.id, strava))
+                    # 凑满一批就不再往后翻页，更早的历史留给下一次运行 (由 before 水位线接上)
+                    if len(to_sync_ids) >= BATCH_SIZE:
+                        break
             
-            # 使用同样的逻辑清洗 Strava 返回的 ID
-            strava_id_str = clean_id(summary.id)
+            print(f"🔍 扫描完成！本批次发现 {len(start_epochs)} 条【缺失】数据待同步。")
             
-            if strava_id_str not in existing_ids:
-                to_sync_ids.append(summary.id) # 记录原始 ID 用于请求
-        
-        print(f"🔍 扫描完成！共发现 {len(to_sync_ids)} 条【缺失】数据待同步。")
-        
-        if not to_sync_ids:
-            print("🎉 所有历史数据已同步完毕！")
-            return
+            if not to_sync_ids:
+                print("🎉 所有历史数据已同步完毕！")
+                return
 
-        # 3. 处理批次
-        current_batch = to_sync_ids[:BATCH_SIZE]
-        print(f"⚙️ 本次运行将处理 {len(current_batch)} 条数据...")
-        
-        new_rows = []
-        for idx, act_id in enumerate(current_batch):
-            print(f"[{idx+1}/{len(current_batch)}] 下载详情 ID: {act_id} ...")
-            row = process_activity_detail(act_id, strava)
-            if row:
+            # 3. 处理批次：按提交顺序取结果，写入顺序与串行时一致
+            current_batch = to_sync_ids
+            print(f"⚙️ 本次运行将处理 {len(current_batch)} 条数据...")
+            for idx, (act_id, future) in enumerate(zip(current_batch, futures)):
+                row = future.result()
+                key = clean_id(act_id)
+                if not row:
+                    # 跳过这条，其余照常写入；记进失败名单，下次运行优先重试 (水位线照常推进，不会卡住后面的活动)
+                    attempts = failed_attempts.get(key, 0) + 1
+                    if attempts >= MAX_ATTEMPTS:
+                        print(f"🚫 [{idx+1}/{len(current_batch)}] ID: {act_id} 已失败 {attempts} 次，放弃同步")
+                        failed_attempts.pop(key, None)
+                    else:
+                        print(f"⏭️ [{idx+1}/{len(current_batch)}] 跳过 ID: {act_id}，下次重试 (第 {attempts} 次失败)")
+                        failed_attempts[key] = attempts
+                    continue
+                print(f"[{idx+1}/{len(current_batch)}] 已下载详情 ID: {act_id}")
+                failed_attempts.pop(key, None)
                 new_rows.append(row)
-            time.sleep(0.5)
             
 # ... (前面的代码不变) ...
 
+        row_count = sheet.row_count
         if new_rows:
-            # 这里原本是 new_rows.reverse()，如果你希望最新的在最上面，可以去掉 reverse
-            # 但为了保险，我们不管怎么插入，最后都做一个全表排序
+            # 表是按日期降序排好的 (最新的在最上面)，而新发现的行要么比表里所有行都新，要么都旧 (回溯的历史)：
+            # 新的插到表头下面，旧的追加到末尾，不用整表排序。
+            # 日期落在中间的 (重试补回的失败活动、或表被手动改过) 才退回排序
+            by_date = sorted(new_rows, key=lambda r: r[1], reverse=True)
+            # 空表时直接按降序写在表头下面；不知道表里日期范围时全部追加后排序
+            order_known = date_range is not None or not existing_ids
+            top_rows, bottom_rows, middle_rows = [], [], []
+            for r in by_date:
+                if not existing_ids or (date_range and r[1] >= date_range[0]):
+                    top_rows.append(r)
+                elif date_range and r[1] <= date_range[1]:
+                    bottom_rows.append(r)
+                else:
+                    middle_rows.append(r)
+            
+            batch_requests = []
+            if top_rows:
+                # 在表头下面插入空行 (样式继承下面的数据行)，再把新行写进去
+                batch_requests.append({"insertDimension": {
+                    "range": {"sheetId": sheet.id, "dimension": "ROWS", "startIndex": 1, "endIndex": 1 + len(top_rows)},
+                    "inheritFromBefore": False
+                }})
+                batch_requests.append({"updateCells": {
+                    "start": {"sheetId": sheet.id, "rowIndex": 1, "columnIndex": 0},
+                    "rows": [{"values": [to_cell(v) for v in row]} for row in top_rows],
+                    "fields": "userEnteredValue"
+                }})
+            if bottom_rows or middle_rows:
+                batch_requests.append({"appendCells": {
+                    "sheetId": sheet.id,
+                    "rows": [{"values": [to_cell(v) for v in row]} for row in bottom_rows + middle_rows],
+                    "fields": "userEnteredValue"
+                }})
+            if middle_rows:
+                batch_requests.append({"sortRange": {
+                    # 从第 2 行开始排 (不动表头)，A:R 共 18 列；只排真正占用的行 (表头 + 已有 + 新增)，不按整张表的容量
+                    "range": {"sheetId": sheet.id, "startRowIndex": 1, "endRowIndex": 1 + data_rows + len(new_rows),
+                              "startColumnIndex": 0, "endColumnIndex": 18},
+                    # 假设 Date 是第 2 列 (下标 1)，降序 = 最新的在上面
+                    "sortSpecs": [{"dimensionIndex": 1, "sortOrder": "DESCENDING"}]
+                }})
             
-            print(f"📝 正在写入 Google Sheets...")
-            sheet.append_rows(new_rows)
+            print(f"📝 正在写入 Google Sheets (最新的在最上面)...")
+            # 所有步骤合并成一次 batchUpdate：一次往返，服务器按顺序原子执行
+            response = sheet.spreadsheet.batch_update({"includeSpreadsheetInResponse": True, "requests": batch_requests})
             print(f"✅ 本次批次完成！已同步 {len(new_rows)} 条。")
             
-            # --- 🆕 新增：自动排序逻辑 ---
-            print("🧹 正在按日期重新排序 (最新的在最上面)...")
-            try:
-                # 假设 Date 是第 2 列
-                # range='A2:R' 表示不排序第一行表头，从第2行开始排
-                # sort_order='DES' 表示降序 (最新的在上面)，'ASC' 表示升序 (最旧的在上面)
-                sheet.sort((2, 'des'), range=f'A2:R{sheet.row_count}') 
-            except Exception as e:
-                print(f"排序失败 (可能是权限或表头问题，不影响数据): {e}")
+            # 更新本地同步状态 (行数取写入后返回的表格属性，不用再请求一次)
+            row_count = next(
+                ws['properties']['gridProperties']['rowCount']
+                for ws in response['updatedSpreadsheet']['sheets']
+                if ws['properties']['sheetId'] == sheet.id
+            )
+            existing_ids.update(clean_id(r[0]) for r in new_rows)
+            data_rows += len(new_rows)
+            if order_known:
+                written_dates = [r[1] for r in new_rows] + list(date_range or [])
+                date_range = [max(written_dates), min(written_dates)]
+        
+        # 这一批新发现的活动要么已写入、要么进了失败名单，水位线推进到它们的两头
+        batch_epochs = list(start_epochs.values())
+        if after_epoch is not None:
+            batch_epochs += [after_epoch, before_epoch]
+        if batch_epochs:
+            after_epoch, before_epoch = max(batch_epochs), min(batch_epochs)
+        save_state(row_count, data_rows, existing_ids, after_epoch, before_epoch, date_range, failed_attempts)
 
     except Exception as e:
         print(f"运行出错: {e}")